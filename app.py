@@ -1,4 +1,5 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
@@ -6,198 +7,628 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 import re
 from datetime import datetime
 import requests
+import orjson
+import aiohttp
+import asyncio
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.html
+from lxml import etree
 import subprocess
 import os
+import io
+import hashlib
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
 # Streamlit page configuration
 st.set_page_config(page_title="Amazon Book Reviews Extractor", layout="wide")
 
 # Title and description
 st.title("Amazon Book Reviews Extractor")
-st.markdown("Extract user reviews for a specific book from Amazon using its ASIN and export them to Excel.")
+st.markdown("Extract user reviews for a specific book from Amazon using its ASIN and export them to CSV or Excel.")
 
 # Input fields
 asin = st.text_input("Enter the book's ASIN (e.g., B0CW1LJXKN):", placeholder="10-character ASIN")
+use_selenium = st.checkbox("Render the page with headless Chrome (Selenium)", value=False,
+                           help="Only needed if the reviews are loaded dynamically. Requires Google Chrome.")
+pages = st.number_input("Review pages to fetch:", min_value=1, max_value=10, value=1,
+                        help="Ignored by the Selenium option, which only reads the first page.")
+export_excel = st.checkbox("Also export Excel", value=False)
+force_refresh = st.checkbox("Force refresh (ignore cached results)", value=False)
 submit_button = st.button("Extract Reviews")
 
-# Function to clean text
+# Browser-like headers for requests to Amazon
+HEADERS = {
+    'User-Agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    'Accept-Language': "en-US,en;q=0.9",
+    'Accept': "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    'Accept-Encoding': "gzip, deflate, br",
+}
+
+# Rate-limit and transient server error statuses, retried with exponential backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 4
+# Longest wait between attempts, whatever a Retry-After header asks for
+MAX_RETRY_DELAY = 30
+
+# Function to compute the wait before the next attempt from Retry-After or exponential backoff
+def retry_delay(retry_after, attempt):
+    delay = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+    return min(delay, MAX_RETRY_DELAY)
+
+# Concurrent Gemini calls, matched by the size of the session's connection pool
+GEMINI_MAX_WORKERS = 16
+
+# Shared HTTP session so Gemini requests reuse keep-alive connections
+# Only connection failures (request never sent) are retried here; retryable statuses are handled in call_gemini so every attempt is rate-limited
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    retries = Retry(connect=MAX_ATTEMPTS - 1, read=0, status=0, backoff_factor=1)
+    session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=GEMINI_MAX_WORKERS, max_retries=retries))
+    return session
+
+SESSION = get_session()
+
+# Token bucket allowing `calls` requests per `period` seconds, in bursts of up to `calls`
+class RateLimiter:
+    def __init__(self, calls, period):
+        self.rate = calls / period
+        self.capacity = calls
+        self.tokens = calls
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    # Take `cost` tokens and return how many seconds the caller must wait before using them
+    def reserve(self, cost=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            return max(0.0, -self.tokens / self.rate)
+
+# Named rate limiters shared by all sessions
+@st.cache_resource
+def get_rate_limiter(name, calls, period):
+    return RateLimiter(calls, period)
+
+# Gemini limits both requests and tokens per minute
+GEMINI_LIMITER = get_rate_limiter("generativelanguage.googleapis.com", 60, 60)
+GEMINI_TOKEN_LIMITER = get_rate_limiter("generativelanguage.googleapis.com:tokens", 1_000_000, 60)
+AMAZON_LIMITER = get_rate_limiter("www.amazon.com", 10, 10)
+
+# Precompiled regular expressions
+_ASIN_RE = re.compile(r'^[A-Z0-9]{10}$')
+_SENTIMENT_RE = re.compile(r'(Positive|Negative|Neutral)')
+_NUMBERED_SENTIMENT_RE = re.compile(r'^\s*(\d+)\s*[:.\-]\s*(Positive|Negative|Neutral)', re.M)
+_TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+
+# Function to build an XPath predicate matching one CSS class
+def _has_class(name):
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+# Precompiled XPath expressions for the review page
+_REVIEW_XP = etree.XPath('//div[@data-hook="review"]')
+_FALLBACK_REVIEW_XP = etree.XPath(f'//div[{_has_class("review")}]')
+_USER_XP = etree.XPath(f'.//span[{_has_class("a-profile-name")}] | .//div[{_has_class("a-profile-content")}]//span')
+_BODY_XP = etree.XPath(f'.//span[@data-hook="review-body"] | .//div[{_has_class("review-text")}]')
+_RATING_XP = etree.XPath(f'.//i[@data-hook="review-star-rating"]//span[{_has_class("a-icon-alt")}] | .//i[{_has_class("review-rating")}]//span')
+_DATE_XP = etree.XPath(f'.//span[@data-hook="review-date"] | .//span[{_has_class("review-date")}]')
+
+# Function to clean text, collapsing all whitespace runs in a single C-level split and join
 def clean_text(text):
-    text = re.sub(r'\s+', ' ', text.strip())
-    return text
+    return ' '.join(text.split())
+
+# Function to read the installed Chrome version once per process
+@st.cache_resource
+def _chrome_version():
+    result = subprocess.run(['google-chrome', '--version'], capture_output=True, text=True)
+    return result.stdout.strip()
 
 # Function to check Chrome version
 def get_chrome_version():
     try:
-        result = subprocess.run(['google-chrome', '--version'], capture_output=True, text=True)
-        version = result.stdout.strip()
+        version = _chrome_version()
         st.write(f"Installed Chrome version: {version}")
         return version
     except Exception as e:
         st.error(f"Error checking Chrome version: {str(e)}. Ensure Google Chrome is installed.")
         return None
 
-# Function to scrape Amazon reviews using Selenium
-def scrape_reviews(asin):
-    driver = None
-    try:
-        # Check Chrome installation
-        chrome_version = get_chrome_version()
-        if not chrome_version:
-            st.error("Google Chrome is not installed. Please install it using: sudo apt-get install -y google-chrome-stable")
-            return []
-        
-        # Set up Selenium with headless Chrome
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-        
-        # Initialize ChromeDriver
-        st.write("Initializing ChromeDriver...")
-        driver = webdriver.Chrome(
-            service=Service(ChromeDriverManager().install()),
-            options=chrome_options
-        )
+# Function to build the URL of a review page
+def review_page_url(asin, page=1):
+    url = f"https://www.amazon.com/product-reviews/{asin}"
+    return url if page == 1 else f"{url}?pageNumber={page}"
+
+# Largest review page accepted, so oversized responses are not buffered or parsed
+MAX_PAGE_BYTES = 5_000_000
+
+# Function to read a response body in chunks, aborting once it exceeds MAX_PAGE_BYTES
+async def read_limited(response):
+    if (response.content_length or 0) > MAX_PAGE_BYTES:
+        raise ValueError(f"Page too large ({response.content_length} bytes)")
+    chunks = []
+    total = 0
+    async for chunk in response.content.iter_chunked(65536):
+        total += len(chunk)
+        if total > MAX_PAGE_BYTES:
+            raise ValueError(f"Page too large (over {MAX_PAGE_BYTES} bytes)")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+# Function to download several review pages concurrently
+async def fetch_all(asin, pages, max_concurrency=5):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    timeout = aiohttp.ClientTimeout(total=15, connect=5)
+    async with aiohttp.ClientSession(headers=HEADERS, timeout=timeout) as session:
+        async def fetch(page):
+            for attempt in range(MAX_ATTEMPTS):
+                await asyncio.sleep(AMAZON_LIMITER.reserve())
+                async with semaphore, session.get(review_page_url(asin, page)) as response:
+                    if response.status not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+                        response.raise_for_status()
+                        return await read_limited(response)
+                    delay = retry_delay(response.headers.get('Retry-After'), attempt)
+                await asyncio.sleep(delay)
+        return await asyncio.gather(*(fetch(page) for page in range(1, pages + 1)), return_exceptions=True)
+
+# Columns of the scraped review table
+REVIEW_COLUMNS = ('Username', 'Comment', 'Rating', 'Date', 'ASIN')
+
+# Function to create empty review columns
+def new_review_columns():
+    return {column: [] for column in REVIEW_COLUMNS}
+
+# Function to extract the reviews from the raw HTML bytes of a review page into the review columns
+def parse_reviews(html, asin, reviews):
+    if not html.strip():
+        return
+    # Bytes let libxml2 detect the encoding from the page's meta charset in C
+    tree = lxml.html.fromstring(html)
+    review_elements = _REVIEW_XP(tree)
+    if not review_elements:
+        st.warning("No review elements found with 'div[data-hook=\"review\"]'. Trying fallback selectors.")
+        review_elements = _FALLBACK_REVIEW_XP(tree)
+    
+    for element in review_elements:
+        username = _USER_XP(element)
+        username = clean_text(username[0].text_content()) if username else "Anonymous"
         
-        # Log ChromeDriver version
-        driver_version = driver.capabilities['chrome']['chromedriverVersion'].split()[0]
-        st.write(f"ChromeDriver version: {driver_version}")
+        comment_text = _BODY_XP(element)
+        comment_text = clean_text(comment_text[0].text_content()) if comment_text else ""
         
-        # Explicitly use the specified URL format
-        url = f"https://www.amazon.com/product-reviews/{asin}"
-        st.write(f"Scraping URL: {url}")
+        rating = _RATING_XP(element)
+        rating_words = rating[0].text_content().split() if rating else []
+        rating = rating_words[0] if rating_words else "N/A"
         
-        driver.get(url)
+        date = _DATE_XP(element)
+        date = clean_text(date[0].text_content()) if date else "N/A"
         
-        # Wait for reviews to load (up to 15 seconds)
+        if comment_text:
+            reviews['Username'].append(username)
+            reviews['Comment'].append(comment_text)
+            reviews['Rating'].append(rating)
+            reviews['Date'].append(date)
+            reviews['ASIN'].append(asin)
+
+# Raised for failed scrapes, which must not be cached
+class ScrapeError(Exception):
+    pass
+
+# Function to scrape Amazon reviews using aiohttp and lxml
+def scrape_reviews_aiohttp(asin, pages):
+    url = review_page_url(asin)
+    st.write(f"Scraping URL: {url}" + (f" (pages 1-{pages})" if pages > 1 else ""))
+    
+    htmls = asyncio.run(fetch_all(asin, pages))
+    # A partial result must not be cached, so any failed page fails the whole scrape
+    for page, result in enumerate(htmls, start=1):
+        if isinstance(result, Exception):
+            raise ScrapeError(f"Could not fetch review page {page}: {str(result)}. Try again or fetch fewer pages.")
+    
+    # Check for CAPTCHA
+    if any(b'/errors/validateCaptcha' in html for html in htmls):
+        raise ScrapeError("CAPTCHA detected. Amazon is blocking the request. Try manually visiting the URL or use a proxy.")
+    
+    # Debugging: Log page title
+    title_match = _TITLE_RE.search(htmls[0])
+    title = clean_text(title_match.group(1).decode('utf-8', 'replace')) if title_match else ""
+    st.write(f"Page title: {title if title else 'No title found'}")
+    
+    reviews = new_review_columns()
+    for html in htmls:
+        parse_reviews(html, asin, reviews)
+    
+    if not reviews['Comment']:
+        raise ScrapeError("No valid reviews extracted. Possible reasons: no reviews exist, the page requires JavaScript (try the Selenium option) or further interaction.")
+    st.success(f"Found {len(reviews['Comment'])} reviews.")
+    return reviews
+
+# Function to scrape reviews with the selected scraper, caching only successful scrapes
+@st.cache_data(ttl=3600, show_spinner=False)
+def _scrape_reviews_cached(asin, use_selenium, pages):
+    if use_selenium:
+        return scrape_reviews_selenium(asin)
+    return scrape_reviews_aiohttp(asin, pages)
+
+# Function to scrape Amazon reviews, returning empty review columns on failure
+def scrape_reviews(asin, use_selenium=False, pages=1):
+    try:
+        return _scrape_reviews_cached(asin, use_selenium, pages)
+    except ScrapeError as e:
+        st.error(str(e))
+    except Exception as e:
+        st.error(f"Error during scraping: {str(e)}")
+    return new_review_columns()
+
+# Script run in the browser to extract the CAPTCHA state, title and reviews in one round-trip
+_EXTRACT_REVIEWS_JS = """
+const text = (root, selector) => {
+    const element = root.querySelector(selector);
+    return element ? element.textContent : '';
+};
+let elements = document.querySelectorAll('div[data-hook="review"]');
+const fallback = elements.length === 0;
+if (fallback) {
+    elements = document.querySelectorAll('div.a-section.review, div.review');
+}
+return {
+    captcha: !!document.querySelector('form[action="/errors/validateCaptcha"]'),
+    title: document.title,
+    fallback: fallback,
+    reviews: Array.from(elements).map(review => ({
+        user: text(review, 'span.a-profile-name, div.a-profile-content span'),
+        body: text(review, 'span[data-hook="review-body"], div.review-text'),
+        rating: text(review, 'i[data-hook="review-star-rating"] span.a-icon-alt, i.review-rating span'),
+        date: text(review, 'span[data-hook="review-date"], span.review-date'),
+    })),
+};
+"""
+
+# Function to resolve the ChromeDriver binary once per process
+@st.cache_resource
+def get_chromedriver_path():
+    return ChromeDriverManager().install()
+
+# Function to create a headless Chrome driver that is reused across scrapes
+@st.cache_resource
+def get_driver():
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument(f"user-agent={HEADERS['User-Agent']}")
+    
+    driver = webdriver.Chrome(
+        service=Service(get_chromedriver_path()),
+        options=chrome_options
+    )
+    get_driver_holder()['driver'] = driver
+    return driver
+
+# Function to quit the driver currently held, if any
+def _quit_driver(holder):
+    driver, holder['driver'] = holder['driver'], None
+    if driver:
         try:
-            WebDriverWait(driver, 15).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, 'div[data-hook="review"], div.a-section.review'))
-            )
-        except:
-            st.warning("Reviews not loaded within 15 seconds. Checking for CAPTCHA or no reviews.")
-        
-        # Check for CAPTCHA
-        if driver.find_elements(By.CSS_SELECTOR, 'form[action="/errors/validateCaptcha"]'):
-            st.error("CAPTCHA detected. Amazon is blocking the request. Try manually visiting the URL or use a proxy.")
-            return []
-        
-        # Debugging: Log page title
-        title = driver.title
-        st.write(f"Page title: {title if title else 'No title found'}")
-        
-        # Find review elements
-        review_elements = driver.find_elements(By.CSS_SELECTOR, 'div[data-hook="review"]')
-        if not review_elements:
-            st.warning("No review elements found with 'div[data-hook=\"review\"]'. Trying fallback selectors.")
-            review_elements = driver.find_elements(By.CSS_SELECTOR, 'div.a-section.review, div.review')
+            driver.quit()
+        except Exception:
+            pass
+
+# Holder for the currently cached driver; its single shutdown hook is registered once per process
+@st.cache_resource
+def get_driver_holder():
+    holder = {'driver': None}
+    atexit.register(_quit_driver, holder)
+    return holder
+
+# Lock serializing use of the shared driver between sessions
+@st.cache_resource
+def get_driver_lock():
+    return threading.Lock()
+
+# Function to scrape Amazon reviews using Selenium (opt-in, for dynamically loaded pages)
+def scrape_reviews_selenium(asin):
+    driver = None
+    try:
+        # Check Chrome installation
+        chrome_version = get_chrome_version()
+        if not chrome_version:
+            raise ScrapeError("Google Chrome is not installed. Please install it using: sudo apt-get install -y google-chrome-stable")
         
-        reviews = []
-        for element in review_elements:
-            try:
-                username = element.find_element(By.CSS_SELECTOR, 'span.a-profile-name, div.a-profile-content span')
-                username = clean_text(username.text) if username else "Anonymous"
-            except:
-                username = "Anonymous"
-                
-            try:
-                comment_text = element.find_element(By.CSS_SELECTOR, 'span[data-hook="review-body"], div.review-text')
-                comment_text = clean_text(comment_text.text) if comment_text else ""
-            except:
-                comment_text = ""
-                
+        with get_driver_lock():
+            driver = get_driver()
+            
+            # Log ChromeDriver version
+            driver_version = driver.capabilities['chrome']['chromedriverVersion'].split()[0]
+            st.write(f"ChromeDriver version: {driver_version}")
+            
+            # Explicitly use the specified URL format
+            url = f"https://www.amazon.com/product-reviews/{asin}"
+            st.write(f"Scraping URL: {url}")
+            
+            driver.get(url)
+            
+            # Wait for reviews to load (up to 15 seconds)
             try:
-                rating = element.find_element(By.CSS_SELECTOR, 'i[data-hook="review-star-rating"] span.a-icon-alt, i.review-rating span')
-                rating = clean_text(rating.text.split()[0]) if rating else "N/A"
-            except:
-                rating = "N/A"
+                WebDriverWait(driver, 15).until(
+                    EC.presence_of_element_located((By.CSS_SELECTOR, 'div[data-hook="review"], div.a-section.review'))
+                )
+            except TimeoutException:
+                st.warning("Reviews not loaded within 15 seconds. Checking for CAPTCHA or no reviews.")
+            
+            # Collect CAPTCHA state, title and all review fields in a single WebDriver call
+            data = driver.execute_script(_EXTRACT_REVIEWS_JS)
+            
+            # Check for CAPTCHA
+            if data['captcha']:
+                raise ScrapeError("CAPTCHA detected. Amazon is blocking the request. Try manually visiting the URL or use a proxy.")
+            
+            # Debugging: Log page title
+            title = data['title']
+            st.write(f"Page title: {title if title else 'No title found'}")
+            
+            if data['fallback']:
+                st.warning("No review elements found with 'div[data-hook=\"review\"]'. Trying fallback selectors.")
+            
+            reviews = new_review_columns()
+            for review in data['reviews']:
+                username = clean_text(review['user']) or "Anonymous"
+                comment_text = clean_text(review['body'])
+                rating_words = review['rating'].split()
+                rating = rating_words[0] if rating_words else "N/A"
+                date = clean_text(review['date']) or "N/A"
                 
-            try:
-                date = element.find_element(By.CSS_SELECTOR, 'span[data-hook="review-date"], span.review-date')
-                date = clean_text(date.text) if date else "N/A"
-            except:
-                date = "N/A"
+                if comment_text:
+                    reviews['Username'].append(username)
+                    reviews['Comment'].append(comment_text)
+                    reviews['Rating'].append(rating)
+                    reviews['Date'].append(date)
+                    reviews['ASIN'].append(asin)
             
-            if comment_text:
-                reviews.append({
-                    'Username': username,
-                    'Comment': comment_text,
-                    'Rating': rating,
-                    'Date': date,
-                    'ASIN': asin
-                })
-        
-        if not reviews:
-            st.warning("No valid reviews extracted. Possible reasons: no reviews exist or page requires further interaction.")
-        else:
-            st.success(f"Found {len(reviews)} reviews.")
-        
-        return reviews
-    except Exception as e:
-        st.error(f"Error during scraping: {str(e)}")
-        return []
-    finally:
+            if not reviews['Comment']:
+                raise ScrapeError("No valid reviews extracted. Possible reasons: no reviews exist or page requires further interaction.")
+            st.success(f"Found {len(reviews['Comment'])} reviews.")
+            return reviews
+    except ScrapeError:
+        raise
+    except Exception:
+        # Discard the shared driver in case the browser session is broken
         if driver:
-            driver.quit()
+            with get_driver_lock():
+                _quit_driver(get_driver_holder())
+                get_driver.clear()
+        raise
+
+# Gemini endpoint, headers and prompts used for sentiment analysis
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+GEMINI_HEADERS = {'Content-Type': 'application/json'}
+PROMPT_TEMPLATE = "Analyze the sentiment of this book review: '{comment}'. Return 'Positive', 'Negative', or 'Neutral'."
+BATCH_PROMPT_HEADER = "For each numbered comment below, output one line 'i: Positive|Negative|Neutral'.\n"
+BATCH_SIZE = 25
+
+# Function to shorten long comments to their head and tail, which carry the sentiment
+def snippet(comment):
+    return comment if len(comment) <= 800 else comment[:600] + ' ... ' + comment[-200:]
+
+# Function to send a prompt to Gemini and return the generated text
+def call_gemini(prompt, api_key, max_output_tokens):
+    data = {
+        "contents": [{
+            "parts": [{"text": prompt}]
+        }],
+        "generationConfig": {"maxOutputTokens": max_output_tokens, "temperature": 0}
+    }
+    
+    body = orjson.dumps(data)
+    # The key goes in a header rather than the URL, so it never appears in raise_for_status() messages
+    headers = {**GEMINI_HEADERS, 'x-goog-api-key': api_key}
+    
+    # Roughly 4 characters per prompt token
+    token_cost = len(prompt) // 4 + max_output_tokens
+    for attempt in range(MAX_ATTEMPTS):
+        # Every attempt, including retries, is counted against the request and token budgets
+        time.sleep(max(GEMINI_LIMITER.reserve(), GEMINI_TOKEN_LIMITER.reserve(token_cost)))
+        response = SESSION.post(GEMINI_URL, data=body, headers=headers, timeout=(5, 30))
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+            break
+        time.sleep(retry_delay(response.headers.get('Retry-After'), attempt))
+    response.raise_for_status()
+    result = orjson.loads(response.content)
+    return result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+
+# Thread-safe LRU map from normalized comment hash to the sentiment Gemini returned
+class SentimentCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+    
+    def put(self, key, sentiment):
+        with self.lock:
+            self.entries[key] = sentiment
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+# Sentiment cache shared by all sessions and reruns
+@st.cache_resource
+def get_sentiment_cache():
+    return SentimentCache(maxsize=4096)
+
+SENTIMENT_CACHE = get_sentiment_cache()
+
+# Function to compute the cache key of a comment, so "Great!" and "great!" share an entry
+def sentiment_key(comment):
+    return hashlib.sha1(clean_text(comment).lower().encode()).hexdigest()
 
 # Function to call Gemini API for sentiment analysis
-def analyze_sentiment(comment):
+def analyze_sentiment(comment, api_key=None):
+    if not comment or not comment.strip():
+        return "Neutral"
+    key = sentiment_key(comment)
+    cached = SENTIMENT_CACHE.get(key)
+    if cached:
+        return cached
     try:
-        api_key = st.secrets["GEMINI_API_KEY"]
-        url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
-        headers = {'Content-Type': 'application/json'}
-        data = {
-            "contents": [{
-                "parts": [{"text": f"Analyze the sentiment of this book review: '{comment}'. Return 'Positive', 'Negative', or 'Neutral'."}]
-            }]
-        }
-        
-        response = requests.post(f"{url}?key={api_key}", json=data, headers=headers)
-        response.raise_for_status()
-        result = response.json()
-        sentiment = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', 'Neutral')
-        return sentiment.strip()
+        api_key = api_key or st.secrets["GEMINI_API_KEY"]
+        text = call_gemini(PROMPT_TEMPLATE.format(comment=snippet(comment)), api_key, max_output_tokens=4)
+        # Only a recognized label is returned and cached; anything else (preamble, markdown) falls back to Neutral
+        match = _SENTIMENT_RE.search(text)
+        if not match:
+            return "Neutral"
+        SENTIMENT_CACHE.put(key, match.group(1))
+        return match.group(1)
     except Exception as e:
         st.warning(f"Error analyzing sentiment: {str(e)}")
         return "Neutral"
 
+# Function to analyze a batch of comments in a single Gemini call, returning None where the reply left a comment out
+def analyze_batch(batch, api_key):
+    try:
+        prompt = BATCH_PROMPT_HEADER + "\n".join(f"{i+1}. {snippet(c)}" for i, c in enumerate(batch))
+        text = call_gemini(prompt, api_key, max_output_tokens=8 * len(batch))
+    except Exception as e:
+        # The API is refusing or failing this request, so retrying each comment separately would only add load
+        st.warning(f"Error analyzing sentiment in batch: {str(e)}. Marking {len(batch)} reviews as Neutral.")
+        return ["Neutral"] * len(batch)
+    
+    sentiments = [None] * len(batch)
+    for number, sentiment in _NUMBERED_SENTIMENT_RE.findall(text):
+        index = int(number) - 1
+        if 0 <= index < len(batch):
+            sentiments[index] = sentiment
+    for comment, sentiment in zip(batch, sentiments):
+        if sentiment:
+            SENTIMENT_CACHE.put(sentiment_key(comment), sentiment)
+    missing = sentiments.count(None)
+    if missing:
+        st.warning(f"Batch sentiment response had no result for {missing} of {len(batch)} reviews. Falling back to one call per review for those.")
+    return sentiments
+
+# Function to analyze the sentiment of all comments in batches of BATCH_SIZE per Gemini call
+def analyze_sentiments(comments):
+    # Comments already in the cache, or normalizing to the same key, are not sent again
+    keys = [sentiment_key(comment) for comment in comments]
+    sentiments = {key: SENTIMENT_CACHE.get(key) for key in keys}
+    pending = {}
+    for key, comment in zip(keys, comments):
+        if sentiments[key] is None:
+            if comment.strip():
+                pending.setdefault(key, comment)
+            else:
+                sentiments[key] = "Neutral"
+    if not pending:
+        return [sentiments[key] for key in keys]
+    
+    try:
+        api_key = st.secrets["GEMINI_API_KEY"]
+    except Exception as e:
+        st.warning(f"Error analyzing sentiment: {str(e)}")
+        return [sentiments[key] or "Neutral" for key in keys]
+    
+    # Batches and fallback calls are network-bound, so they run concurrently
+    pending_comments = list(pending.values())
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=GEMINI_MAX_WORKERS, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        batches = [pending_comments[i:i + BATCH_SIZE] for i in range(0, len(pending_comments), BATCH_SIZE)]
+        results = executor.map(lambda batch: analyze_batch(batch, api_key), batches)
+        pending_sentiments = [sentiment for batch_sentiments in results for sentiment in batch_sentiments]
+        
+        # Fallback: one call per review for the comments the batches did not cover
+        missing = [i for i, sentiment in enumerate(pending_sentiments) if sentiment is None]
+        for i, sentiment in zip(missing, executor.map(lambda i: analyze_sentiment(pending_comments[i], api_key), missing)):
+            pending_sentiments[i] = sentiment
+    
+    sentiments.update(zip(pending, pending_sentiments))
+    return [sentiments[key] for key in keys]
+
+# Local VADER sentiment analyzer, loaded once per process
+@st.cache_resource
+def get_vader():
+    return SentimentIntensityAnalyzer()
+
+# Function to classify clear-cut or very short comments locally, returning None when Gemini is needed
+def pre_classify(comment):
+    score = get_vader().polarity_scores(comment)['compound']
+    if abs(score) <= 0.6 and len(comment) >= 20:
+        return None
+    if score >= 0.05:
+        return "Positive"
+    if score <= -0.05:
+        return "Negative"
+    return "Neutral"
+
+# Function to analyze a set of review comments
+def analyze_reviews(comments):
+    # Identical comments are analyzed once
+    sentiments = {comment: pre_classify(comment) for comment in dict.fromkeys(comments)}
+    # Only the ambiguous comments are sent to Gemini
+    pending = [comment for comment, sentiment in sentiments.items() if sentiment is None]
+    sentiments.update(zip(pending, analyze_sentiments(pending)))
+    return [sentiments[comment] for comment in comments]
+
 # Main logic
 if submit_button and asin:
     # Validate ASIN format (10 characters, alphanumeric)
-    if not re.match(r'^[A-Z0-9]{10}$', asin):
+    if not _ASIN_RE.match(asin):
         st.error("Please enter a valid 10-character ASIN.")
     else:
+        if force_refresh:
+            st.cache_data.clear()
+        
         with st.spinner("Extracting reviews..."):
-            reviews = scrape_reviews(asin)
+            reviews = scrape_reviews(asin, use_selenium=use_selenium, pages=int(pages))
             
-            if reviews:
+            if reviews['Comment']:
                 # Add sentiment analysis
-                for review in reviews:
-                    review['Sentiment'] = analyze_sentiment(review['Comment'])
+                reviews['Sentiment'] = analyze_reviews(reviews['Comment'])
                 
-                # Create DataFrame
-                df = pd.DataFrame(reviews)
+                # Create DataFrame, with every column stored as pandas' string dtype
+                df = pd.DataFrame({column: pd.array(values, dtype='string') for column, values in reviews.items()})
                 
                 # Display results
                 st.subheader(f"Reviews for Book (ASIN: {asin})")
                 st.dataframe(df)
                 
-                # Export to Excel
+                # Export to CSV
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"amazon_book_{asin}_reviews_{timestamp}.xlsx"
-                df.to_excel(filename, index=False)
+                filename = f"amazon_book_{asin}_reviews_{timestamp}"
+                st.download_button(
+                    label="Download CSV file",
+                    data=df.to_csv(index=False).encode('utf-8'),
+                    file_name=f"{filename}.csv",
+                    mime="text/csv"
+                )
                 
-                # Provide download button
-                with open(filename, "rb") as file:
+                # Export to Excel only when requested, since it is much slower than the CSV writer
+                if export_excel:
+                    buffer = io.BytesIO()
+                    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+                        df.to_excel(writer, index=False)
+                    
                     st.download_button(
                         label="Download Excel file",
-                        data=file,
-                        file_name=filename,
+                        data=buffer.getvalue(),
+                        file_name=f"{filename}.xlsx",
                         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                     )
             else:
@@ -214,9 +645,9 @@ st.sidebar.markdown(
     ```
     3. Install required packages:
     ```
-    pip install streamlit pandas selenium webdriver-manager openpyxl requests
+    pip install streamlit pandas lxml selenium webdriver-manager xlsxwriter requests orjson aiohttp brotli vaderSentiment
     ```
-    4. Install Google Chrome and dependencies (Linux):
+    4. (Optional, only for the Selenium option) Install Google Chrome and dependencies (Linux):
     ```
     sudo apt-get update
     sudo apt-get install -y wget unzip libxss1 libappindicator1 libindicator7 libnss3 libx11-xcb1 libasound2 libatk1.0-0 libatk-bridge2.0-0 libcups2 libdbus-1-3 libdrm2 libgbm1 libgtk-3-0
@@ -229,7 +660,7 @@ st.sidebar.markdown(
     streamlit run app.py
     ```
     6. Enter a valid 10-character ASIN (e.g., B0CW1LJXKN).
-    7. The app scrapes reviews from `https://www.amazon.com/product-reviews/<ASIN>` using Selenium.
+    7. The app scrapes reviews from `https://www.amazon.com/product-reviews/<ASIN>` using `aiohttp`, fetching the selected number of pages concurrently. Enable the Selenium option to render the page in headless Chrome instead.
     8. If no reviews are found:
        - Verify reviews exist by visiting the URL in your browser.
        - Check for CAPTCHA in debug messages.